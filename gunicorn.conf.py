@@ -0,0 +1,17 @@
+# Configuración de gunicorn para producción:
+#   gunicorn -c gunicorn.conf.py server:app
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "127.0.0.1:5000")
+
+# Las peticiones solo validan, encolan y consultan estado (el mallado va al pool de
+# procesos o a Celery): un worker con hilos basta y así hay un único pool (EXECUTOR,
+# MESH_WORKERS procesos) por servidor. Más workers multiplican los pools; el estado
+# de los jobs está en disco, así que funciona, pero conviene usar Celery para escalar.
+workers = int(os.environ.get("GUNICORN_WORKERS", 1))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+timeout = 120
+
+# sin preload: el pool de procesos (forkserver) se crea dentro del worker
+preload_app = False
@@ -1,15 +1,37 @@
 # procesar_ecuador.py
 import os
-import datetime
+import json
+import struct
+import pickle
+import shutil
+import subprocess
+import tempfile
+import time
+import uuid
+import threading
+
 import rasterio
 import numpy as np
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d
 import trimesh
 import geopandas as gpd
 import rasterio.mask
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask, geometry_window
 from rasterio.transform import Affine
+from shapely.geometry import mapping
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit, prange, set_num_threads, config as numba_config
+except ImportError:  # numba es opcional: sin él se usa la versión NumPy
+    njit = None
+
+try:
+    import DracoPy
+except ImportError:  # DracoPy es opcional: sin él se exporta GLB sin comprimir
+    DracoPy = None
+
 # === CONFIGURACIÓN ===
 DATA_DIR = "data"
 OUTPUT_DIR = "outputs"
@@ -18,19 +40,49 @@ MOSAIC_PATH = os.path.join(DATA_DIR, "mosaic.tif")
 SIGMA = 1.5      # valor por defecto para suavizado (0 = sin suavizado)
 VSCALE = 1.5       # exageración vertical
 MAXDIM = 100000      # tamaño máximo (en pixels) para evitar modelos muy pesados
+DRACO_LEVEL = 4      # nivel de compresión Draco (0-10): prioriza velocidad sobre tamaño
+DRACO_BITS = 14      # bits de cuantización de las posiciones en Draco
+ESTADO_FILENAME = "estado.json"  # estado del job en outputs/<job_id>/ (ver escribir_estado)
+PREVIEW_FACTOR = 4   # decimación por eje de la vista previa (el STL de /api/clip no se decima)
+GDAL_CACHE_MB = 1024  # caché de bloques de GDAL para toda la máquina (se reparte, ver configurar_proceso)
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+# colormap de alturas (LUT RGB precalculada una sola vez)
+_TERRAIN_CMAP = plt.get_cmap("terrain")
+_TERRAIN_LUT = _TERRAIN_CMAP(np.arange(_TERRAIN_CMAP.N))[:, :3].astype(np.float32)
+
+# datasets del mosaico abiertos por hilo (ver abrir_mosaico)
+_MOSAICOS = threading.local()
+
 
 # === FUNCIONES ===
 
+def cargar_frontera(geojson_path=GEOJSON_ECUADOR):
+    """
+    Devuelve la unión (shapely, EPSG:4326) de las geometrías del geojson.
+    Se cachea en un pickle junto al geojson y se regenera si el geojson es más nuevo.
+    """
+    cache = geojson_path + ".pkl"
+    if os.path.exists(cache) and os.path.getmtime(cache) > os.path.getmtime(geojson_path):
+        with open(cache, "rb") as fh:
+            return pickle.load(fh)
+
+    union = gpd.read_file(geojson_path).to_crs("EPSG:4326").unary_union
+    # escritura atómica: varios workers pueden arrancar a la vez y leer el pickle
+    tmp = f"{cache}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        pickle.dump(union, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, cache)
+    return union
+
+
 def recortar_tif_by_geojson(geojson_path=GEOJSON_ECUADOR, out_name="ecuador.tif"):
     """Recorta mosaic.tif usando todo el geojson (Ecuador) y guarda data/ecuador.tif"""
     if not os.path.exists(MOSAIC_PATH):
         raise FileNotFoundError(f"No se encuentra {MOSAIC_PATH}")
 
-    gdf = gpd.read_file(geojson_path)
-    shapes = [feature["geometry"] for feature in gdf.__geo_interface__["features"]]
+    shapes = [mapping(cargar_frontera(geojson_path))]
 
     with rasterio.open(MOSAIC_PATH) as src:
         out_image, out_transform = rasterio.mask.mask(src, shapes, crop=True)
@@ -50,17 +102,133 @@ def recortar_tif_by_geojson(geojson_path=GEOJSON_ECUADOR, out_name="ecuador.tif"
     return out_path
 
 
-def suavizar_y_escalar(tif_path, sigma=SIGMA):
+if njit is not None:
+    # fastmath sin "nnan": el test v == v debe seguir detectando NaN
+    @njit(parallel=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"}, cache=True)
+    def _rebin_nanmean(arr, rr, cc, out):
+        for i in prange(out.shape[0]):
+            for j in range(out.shape[1]):
+                s = 0.0
+                n = 0
+                for ii in range(rr[i], rr[i + 1]):
+                    for jj in range(cc[j], cc[j + 1]):
+                        v = arr[ii, jj]
+                        if v == v:
+                            s += v
+                            n += 1
+                out[i, j] = s / n if n else np.nan
+
+    @njit(inline="always")
+    def _reflejar(k, n):
+        # índice con borde "reflect" de scipy.ndimage: (d c b a | a b c d | d c b a)
+        while k < 0 or k >= n:
+            k = -k - 1 if k < 0 else 2 * n - k - 1
+        return k
+
+    @njit(parallel=True, fastmath={"nsz", "arcp", "contract", "afn", "reassoc"}, cache=True)
+    def _gauss_nan(arr, w, num, den, out):
+        # convolución gaussiana normalizada en dos pasadas 1D; los NaN no suman
+        # ni pesan. out puede ser arr (solo se relee arr[i, j] en la 2ª pasada).
+        rows, cols = arr.shape
+        r = w.shape[0] // 2
+        for i in prange(rows):
+            # fila con borde reflejado: valores (NaN -> 0) y pesos de validez
+            v = np.empty(cols + 2 * r)
+            m = np.empty(cols + 2 * r)
+            for j in range(cols + 2 * r):
+                x = arr[i, _reflejar(j - r, cols)]
+                valido = x == x
+                v[j] = x if valido else 0.0
+                m[j] = 1.0 if valido else 0.0
+            s = np.zeros(cols)
+            n = np.zeros(cols)
+            for k in range(2 * r + 1):
+                wk = w[k]
+                for j in range(cols):
+                    s[j] += wk * v[j + k]
+                    n[j] += wk * m[j + k]
+            for j in range(cols):
+                num[i, j] = s[j]
+                den[i, j] = n[j]
+        for i in prange(rows):
+            s = np.zeros(cols)
+            n = np.zeros(cols)
+            for k in range(-r, r + 1):
+                ii = _reflejar(i + k, rows)
+                wk = w[k + r]
+                for j in range(cols):
+                    s[j] += wk * num[ii, j]
+                    n[j] += wk * den[ii, j]
+            for j in range(cols):
+                v = arr[i, j]
+                out[i, j] = s[j] / max(n[j], 1e-6) if v == v else np.nan
+else:
+    _rebin_nanmean = None
+    _gauss_nan = None
+
+
+def _kernel_gauss(sigma, truncate=4.0):
+    """Pesos 1D normalizados, igual que scipy.ndimage.gaussian_filter1d."""
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1, dtype=np.float64)
+    w = np.exp(-0.5 / float(sigma) ** 2 * x ** 2)
+    return w / w.sum()
+
+
+def block_mean_nan(arr, fr, fc):
     """
-    Lee tif_path y devuelve (arr, profile, transform).
-    - arr: 2D float32 (posible downsample)
-    - profile: profile original (actualizado si hubo downsample)
-    - transform: transform actualizado
+    Media por bloques (fr x fc) ignorando NaN.
+    Los bordes que no completan un bloque se promedian con lo que haya, por lo
+    que la salida tiene shape (ceil(rows/fr), ceil(cols/fc)).
+    Usa el kernel de numba si está instalado; si no, un reshape vectorizado.
+    """
+    if _rebin_nanmean is not None:
+        rows, cols = arr.shape
+        nr, nc = -(-rows // fr), -(-cols // fc)
+        rr = np.minimum(np.arange(nr + 1) * fr, rows)
+        cc = np.minimum(np.arange(nc + 1) * fc, cols)
+        out = np.empty((nr, nc), dtype=arr.dtype)
+        _rebin_nanmean(arr, rr, cc, out)
+        return out
+
+    pad_r = (-arr.shape[0]) % fr
+    pad_c = (-arr.shape[1]) % fc
+    # np.pad siempre copia: solo rellenar si los bloques no cierran exactos
+    a = np.pad(arr, ((0, pad_r), (0, pad_c)), constant_values=np.nan) if pad_r or pad_c else arr
+    nr, nc = a.shape[0] // fr, a.shape[1] // fc
+    return np.nanmean(a.reshape(nr, fr, nc, fc), axis=(1, 3))
+
+
+def leer_tif(tif_path):
+    """
+    Lee la banda 1 de tif_path y devuelve (arr, profile, transform).
+    Si el raster es muy grande (por dimensión mayor) se decima en la lectura
+    (promedio en GDAL, usando overviews si existen).
     """
     with rasterio.open(tif_path) as src:
-        arr = src.read(1).astype(np.float32)
+        H, W = src.height, src.width
+        factor = max(1, int(max(H, W) / MAXDIM))
+        nh, nw = max(1, H // factor), max(1, W // factor)
+        arr = src.read(1, out_shape=(nh, nw), resampling=Resampling.average).astype(np.float32, copy=False)
         profile = src.profile.copy()
-        transform = src.transform
+        transform = src.transform * Affine.scale(W / nw, H / nh)
+
+    profile.update({"height": nh, "width": nw, "transform": transform})
+    return arr, profile, transform
+
+
+def suavizar_y_escalar(arr, transform, profile, sigma=SIGMA):
+    """
+    Recibe el raster ya en memoria (p.ej. el array de recortar_mosaico) y
+    devuelve (arr, profile, transform).
+    - arr: 2D float32 (posible downsample); si ya es float32 se modifica in-place
+    - profile: profile recibido (actualizado si hubo downsample)
+    - transform: transform actualizado
+    """
+    # float32 contiguo (el HGT es int16; float64 duplicaría el tráfico de memoria
+    # del suavizado); sin copia si ya lo es
+    arr = np.ascontiguousarray(arr, dtype=np.float32)
+    profile = profile.copy()
 
     # nodata -> NaN
     nod = profile.get("nodata", None)
@@ -68,69 +236,75 @@ def suavizar_y_escalar(tif_path, sigma=SIGMA):
         # intentar heurística común
         nod = -32768
     arr[arr == nod] = np.nan
+    profile.update({"dtype": "float32", "nodata": np.nan})
 
     # Downsample si arr muy grande (por dimensión mayor)
     nrows, ncols = arr.shape
     factor = max(1, int(max(nrows, ncols) / MAXDIM))
     if factor > 1:
         # re-sample por rebin simple (media ignorando NaN)
-        new_rows = int(np.ceil(nrows / factor))
-        new_cols = int(np.ceil(ncols / factor))
-        arr_ds = np.full((new_rows, new_cols), np.nan, dtype=np.float32)
-        rr = np.linspace(0, nrows, new_rows + 1, dtype=int)
-        cc = np.linspace(0, ncols, new_cols + 1, dtype=int)
-        for i in range(new_rows):
-            for j in range(new_cols):
-                block = arr[rr[i]:rr[i+1], cc[j]:cc[j+1]]
-                if block.size == 0:
-                    arr_ds[i, j] = np.nan
-                else:
-                    arr_ds[i, j] = np.nanmean(block)
-        arr = arr_ds
-        new_transform = Affine(
-            transform.a * factor, transform.b, transform.c,
-            transform.d, transform.e * factor, transform.f
-        )
-    else:
-        new_transform = transform
+        arr = block_mean_nan(arr, factor, factor)
+        transform = transform * Affine.scale(factor)
+        profile.update({"height": arr.shape[0], "width": arr.shape[1], "transform": transform})
 
-    # Suavizado opcional
+    # Suavizado opcional (sin copias si sigma == 0)
     if sigma and sigma > 0:
-        # gaussian_filter preserva NaN? No, por eso aplicamos en máscara
-        nan_mask = np.isnan(arr)
-        arr_filled = np.where(nan_mask, np.nanmedian(arr) if np.isfinite(np.nanmedian(arr)) else 0.0, arr)
-        sm = gaussian_filter(arr_filled, sigma=sigma)
-        # re-aplicar mask para mantener NaN donde no hay datos
-        sm[nan_mask] = np.nan
-        arr = sm.astype(np.float32)
+        invalid = np.isnan(arr)
+        hay_nan = invalid.any()
+        if hay_nan and _gauss_nan is not None:
+            # kernel de numba: ambas pasadas y el manejo de NaN en un solo recorrido
+            del invalid
+            num = np.empty_like(arr)
+            den = np.empty_like(arr)
+            _gauss_nan(arr, _kernel_gauss(sigma), num, den, arr)
+            del num, den
+        elif hay_nan:
+            # convolución normalizada: gauss(datos con NaN=0) / gauss(máscara de válidos),
+            # separable en dos pasadas 1D; no sesga los bordes con un valor de relleno
+            mask = (~invalid).astype(np.float32)
+            arr[invalid] = 0.0
+            for axis in (0, 1):
+                gaussian_filter1d(arr, sigma, axis=axis, output=arr)
+                gaussian_filter1d(mask, sigma, axis=axis, output=mask)
+            np.maximum(mask, 1e-6, out=mask)
+            arr /= mask
+            del mask
+            # re-aplicar mask para mantener NaN donde no hay datos
+            arr[invalid] = np.nan
+        else:
+            for axis in (0, 1):
+                gaussian_filter1d(arr, sigma, axis=axis, output=arr)
 
-    return arr, profile, new_transform
+    return arr, profile, transform
 
 
-def generar_color_por_altura(arr):
+def generar_color_por_altura(arr, nmin=None, nmax=None, out=None):
     """
-    Devuelve un array (N,3) float (0..1) con colores por altura para la superficie.
-    arr es 2D (rows, cols).
+    Devuelve un array (N,3) float32 (0..1) con colores por altura para la superficie.
+    arr es 2D (rows, cols). nmin/nmax: rango de alturas si el llamador ya lo tiene
+    calculado; los NaN se colorean como la altura mínima.
+    out: buffer (N,3) float32 opcional donde escribir el resultado.
     """
-    flat = arr.ravel()
-    # manejar NaN: sustituir por min-valor para coloreado coherente
-    nan_mask = np.isnan(flat)
-    if nan_mask.all():
+    if out is None:
+        out = np.empty((arr.size, 3), dtype=np.float32)
+    if nmin is None:
+        nmin = np.nanmin(arr)
+    if nmax is None:
+        nmax = np.nanmax(arr)
+    if not np.isfinite(nmin):
         # todo NaN: devolvemos gris
-        return np.tile(np.array([0.6, 0.6, 0.6]), (flat.size, 1))
-
-    minv = np.nanmin(flat)
-    maxv = np.nanmax(flat)
-    if maxv - minv <= 0:
-        norm = np.zeros_like(flat, dtype=np.float32)
+        out[:] = 0.6
+        return out
+
+    # mismo índice que calcula Colormap.__call__ sobre su LUT, pero escribiendo
+    # directo a (N,3) float32 en una sola pasada
+    lut_n = _TERRAIN_LUT.shape[0]
+    if nmax - nmin <= 0:
+        idx = np.zeros(arr.size, dtype=np.intp)
     else:
-        norm = (flat - minv) / (maxv - minv)
-    cmap = plt.get_cmap("terrain")
-    rgba = cmap(norm)  # shape (N,4)
-    rgb = rgba[:, :3]
-    # for NaNs, you may want a transparent or special color; we'll keep them mapped to low color
-    rgb[nan_mask] = np.array([0.9, 0.9, 0.9])  # light gray for no-data
-    return rgb.astype(np.float32)
+        idx = ((arr.ravel() - nmin) * (lut_n / (nmax - nmin))).astype(np.intp)
+    np.take(_TERRAIN_LUT, idx, axis=0, out=out, mode="clip")
+    return out
 
 
 def generar_malla_solida(arr, transform, base_altura=None, vs=VSCALE, vertex_color=True):
@@ -154,119 +328,456 @@ def generar_malla_solida(arr, transform, base_altura=None, vs=VSCALE, vertex_col
     xs_m = (xs - xs[0]) * meters_per_deg
     ys_m = (ys - ys[0]) * 111320.0  # lat to meters approx
 
-    xx, yy = np.meshgrid(xs_m, ys_m)
-    zz = np.where(np.isnan(arr), np.nanmin(arr), arr) * vs
+    nmin = np.nanmin(arr)
+    nmax = np.nanmax(arr)
+    zz = np.nan_to_num(arr, nan=nmin) * np.float32(vs)
+    zmin, zmax = sorted((nmin * vs, nmax * vs))
     # determinar base_altura
     if base_altura is None:
-        finite = zz[np.isfinite(zz)]
-        if finite.size == 0:
+        if not np.isfinite(zmin):
             base_alt = 0.0
         else:
-            minv = np.min(finite)
-            maxv = np.max(finite)
-            base_alt = minv - 0.10 * max(1.0, (maxv - minv))
+            base_alt = zmin - 0.10 * max(1.0, (zmax - zmin))
     else:
         base_alt = base_altura
 
-    # Vértices top
-    verts_top = np.column_stack((xx.ravel(), yy.ravel(), zz.ravel()))
-    N = verts_top.shape[0]
-
-    # Vértices bottom (base plana)
-    verts_bottom = np.column_stack((xx.ravel(), yy.ravel(), np.full(N, base_alt)))
-    verts = np.vstack((verts_top, verts_bottom))
+    # generar borde ordenado (perímetro)
+    N = nrows * ncols
+    perimeter = np.concatenate([
+        np.arange(ncols),                                   # top row left->right
+        np.arange(1, nrows) * ncols + (ncols - 1),          # right col top->bottom
+        (nrows - 1) * ncols + np.arange(ncols - 2, -1, -1), # bottom row right->left
+        np.arange(nrows - 2, 0, -1) * ncols,                # left col bottom->top
+    ])
+    P = perimeter.size
+
+    # un solo buffer de vértices: top [0, N) + bottom [N, N+P]
+    verts = np.empty((N + P + 1, 3), np.float32)
+    verts_top = verts[:N]
+    verts_bottom = verts[N:]
+
+    # Vértices top (broadcast de xs_m / ys_m, sin meshgrid)
+    verts_top[:, 0] = np.broadcast_to(xs_m, (nrows, ncols)).ravel()
+    verts_top[:, 1] = np.broadcast_to(ys_m[:, None], (nrows, ncols)).ravel()
+    verts_top[:, 2] = zz.ravel()
+
+    # Vértices bottom (base plana): solo el perímetro + el centro de la base;
+    # los vértices interiores de la base nunca forman parte de una cara visible
+    verts_bottom[:P, :2] = verts_top[perimeter, :2]
+    verts_bottom[P, 0] = (xs_m[0] + xs_m[-1]) / 2
+    verts_bottom[P, 1] = (ys_m[0] + ys_m[-1]) / 2
+    verts_bottom[:, 2] = base_alt
     offset = N
 
-    faces = []
     # caras top (triangulación regular)
-    for r in range(nrows - 1):
-        for c in range(ncols - 1):
-            v0 = r * ncols + c
-            v1 = v0 + 1
-            v2 = v0 + ncols
-            v3 = v2 + 1
-            faces.append([v0, v2, v1])
-            faces.append([v1, v2, v3])
-
-    # caras base (usar la misma triangulación, pero referida a bottom y con orientación invertida)
-    for r in range(nrows - 1):
-        for c in range(ncols - 1):
-            v0 = offset + r * ncols + c
-            v1 = v0 + 1
-            v2 = v0 + ncols
-            v3 = v2 + 1
-            # invertir orientación para que la normal apunte hacia abajo
-            faces.append([v0, v1, v2])
-            faces.append([v1, v3, v2])
-
-    # generar borde ordenado (perímetro) y crear caras laterales
-    perimeter = []
-    # top row left->right
-    for j in range(0, ncols):
-        perimeter.append(0 * ncols + j)
-    # right col top->bottom (skip first)
-    for i in range(1, nrows):
-        perimeter.append(i * ncols + (ncols - 1))
-    # bottom row right->left (skip last)
-    for j in range(ncols - 2, -1, -1):
-        perimeter.append((nrows - 1) * ncols + j)
-    # left col bottom->top (skip last and first)
-    for i in range(nrows - 2, 0, -1):
-        perimeter.append(i * ncols + 0)
-
-    # crear caras laterales uniendo cada arista (t0->t1) con su correspond. bottom
-    P = len(perimeter)
-    for k in range(P):
-        t0 = perimeter[k]
-        t1 = perimeter[(k + 1) % P]
-        b0 = t0 + offset
-        b1 = t1 + offset
-        # dos triángulos por cara lateral
-        faces.append([t0, b0, t1])
-        faces.append([t1, b0, b1])
-
-    faces = np.array(faces, dtype=np.int64)
+    r, c = np.mgrid[:nrows - 1, :ncols - 1]
+    v0 = (r * ncols + c).ravel()
+    v1 = v0 + 1
+    v2 = v0 + ncols
+    v3 = v2 + 1
+    top_faces = np.stack([
+        np.column_stack([v0, v2, v1]),
+        np.column_stack([v1, v2, v3]),
+    ], axis=1).reshape(-1, 3)
+
+    # caras laterales uniendo cada arista (t0->t1) del perímetro con su correspond. bottom
+    t0 = perimeter
+    t1 = np.roll(perimeter, -1)
+    b0 = offset + np.arange(P)
+    b1 = np.roll(b0, -1)
+    # dos triángulos por cara lateral
+    side_faces = np.stack([
+        np.column_stack([t0, b0, t1]),
+        np.column_stack([t1, b0, b1]),
+    ], axis=1).reshape(-1, 3)
+
+    # caras base: abanico desde el centro sobre el perímetro (la base es un rectángulo
+    # convexo), con orientación para que la normal apunte hacia abajo
+    center = np.full(P, offset + P)
+    bottom_faces = np.column_stack([center, b0, b1])
+
+    faces = np.vstack([top_faces, bottom_faces, side_faces]).astype(np.int32)
 
     # Colores por vértice (opcional)
     vertex_colors = None
     if vertex_color:
-        top_colors = generar_color_por_altura(arr)  # returns N x 3
-        # top_colors is based on arr.ravel() order
-        if top_colors.shape[0] != N:
-            # seguridad: recalc
-            top_colors = generar_color_por_altura(arr.reshape((nrows, ncols)))
+        vertex_colors = np.empty((N + P + 1, 3), dtype=np.float32)
+        # zz ya no tiene NaN; reutilizamos el rango calculado arriba
+        generar_color_por_altura(zz, zmin, zmax, out=vertex_colors[:N])
         # bottom use a uniform earthy color
-        bottom_color = np.array([0.36, 0.28, 0.18], dtype=np.float32)  # brown-ish
-        bottom_colors = np.tile(bottom_color, (N, 1))
-        vertex_colors = np.vstack((top_colors, bottom_colors))
+        vertex_colors[N:] = (0.36, 0.28, 0.18)  # brown-ish
 
+    # malla construida sobre una grilla regular: top [0, N) y base [N, N+P] son disjuntos,
+    # no hay caras duplicadas ni vértices sin referenciar, así que no hace falta limpiarla
     mesh = trimesh.Trimesh(vertices=verts, faces=faces, vertex_colors=vertex_colors, process=False)
-    mesh.remove_duplicate_faces()
-    mesh.remove_unreferenced_vertices()
     return mesh
 
 
+_DRACO_IDS = {}
+
+
+def _draco_ids(con_colores):
+    """
+    unique_id que DracoPy asigna a POSITION (0) y COLOR (2). Dependen solo de la
+    versión de DracoPy y de qué atributos se codifican: se averiguan una vez con
+    un triángulo de prueba.
+    """
+    if con_colores not in _DRACO_IDS:
+        colors = np.zeros((3, 3), np.uint8) if con_colores else None
+        prueba = DracoPy.encode(np.eye(3, dtype=np.float32), np.array([[0, 1, 2]], np.uint32), colors=colors)
+        _DRACO_IDS[con_colores] = {a["attribute_type"]: a["unique_id"] for a in DracoPy.decode(prueba).attributes}
+    return _DRACO_IDS[con_colores]
+
+
+def _leer_varint(buf, i):
+    valor = desplazamiento = 0
+    while True:
+        b = buf[i]
+        i += 1
+        valor |= (b & 0x7F) << desplazamiento
+        desplazamiento += 7
+        if not b & 0x80:
+            return valor, i
+
+
+def _draco_num_puntos(draco, num_caras):
+    """
+    Número de puntos de un mesh Draco 2.2 leído de la cabecera: "DRACO", versión,
+    tipo, método (0 secuencial / 1 edgebreaker), flags y los varints de
+    conectividad. None si el formato no es el esperado (o no cuadran las caras).
+    """
+    if draco[:5] != b"DRACO" or (draco[5], draco[6]) != (2, 2) or draco[7] != 1:
+        return None
+    if int.from_bytes(draco[9:11], "little") & 0x8000:  # con metadata
+        return None
+    if draco[8] == 1:
+        # edgebreaker: tipo de traversal, num_encoded_vertices, num_faces
+        n_puntos, i = _leer_varint(draco, 12)
+        n_caras, _ = _leer_varint(draco, i)
+    elif draco[8] == 0:
+        # secuencial: num_faces, num_points
+        n_caras, i = _leer_varint(draco, 11)
+        n_puntos, _ = _leer_varint(draco, i)
+    else:
+        return None
+    return n_puntos if n_caras == num_caras else None
+
+
+def _draco_min_max(verts, bits):
+    """
+    min/max por eje de las posiciones tal como las devuelve el decodificador:
+    Draco cuantiza con origen = mínimo por eje y un único rango (el mayor lado),
+    en float32; los extremos decodificados pueden salirse de la caja original.
+    """
+    vmin = verts.min(axis=0)
+    rango = np.float32((verts.max(axis=0) - vmin).max())
+    max_q = np.float32((1 << bits) - 1)
+    if rango == 0:
+        return vmin, vmin.copy()
+    q_max = np.floor((verts.max(axis=0) - vmin) * (max_q / rango) + np.float32(0.5))
+    return vmin, q_max * (rango / max_q) + vmin
+
+
+def exportar_glb(mesh, glb_path):
+    """
+    Exporta mesh a GLB. Con DracoPy instalado la geometría (posiciones, caras y
+    colores por vértice) va comprimida con KHR_draco_mesh_compression, que Cesium
+    decodifica en el cliente; sin DracoPy se usa el exportador GLB de trimesh y,
+    si gltfpack está en el PATH, se comprime con meshopt (EXT_meshopt_compression).
+    """
+    # todo se escribe en temporales que no terminan en .glb y se mueve a glb_path
+    # una sola vez al final: glb_path nunca existe a medio escribir
+    tmp = f"{glb_path}.{os.getpid()}.tmp"
+    if DracoPy is None:
+        gltfpack = shutil.which("gltfpack")
+        if gltfpack is None:
+            mesh.export(tmp, file_type="glb")
+        else:
+            # gltfpack elige el formato por la extensión (.glb): se trabaja en un
+            # subdirectorio temporal oculto del job y solo sale el resultado final
+            with tempfile.TemporaryDirectory(prefix=".glb_", dir=os.path.dirname(glb_path) or ".") as tmp_dir:
+                crudo = os.path.join(tmp_dir, "malla.glb")
+                comprimido = os.path.join(tmp_dir, "malla_cc.glb")
+                mesh.export(crudo, file_type="glb")
+                try:
+                    subprocess.run([gltfpack, "-i", crudo, "-o", comprimido, "-cc"],
+                                   check=True, capture_output=True)
+                except subprocess.CalledProcessError:
+                    # si gltfpack falla se queda el GLB sin comprimir
+                    comprimido = crudo
+                os.replace(comprimido, tmp)
+        os.replace(tmp, glb_path)
+        return glb_path
+
+    colors = None
+    if mesh.visual.kind == "vertex":
+        colors = np.ascontiguousarray(mesh.visual.vertex_colors[:, :3], dtype=np.uint8)
+    verts = np.asarray(mesh.vertices, dtype=np.float32)
+    draco = DracoPy.encode(
+        verts,
+        np.asarray(mesh.faces, dtype=np.uint32),
+        quantization_bits=DRACO_BITS, compression_level=DRACO_LEVEL, colors=colors,
+    )
+
+    # ids de atributo y conteos del stream codificado, sin decodificarlo entero:
+    # edgebreaker puede duplicar vértices no-manifold, así que el número de
+    # puntos se lee de la cabecera de conectividad
+    attr_ids = _draco_ids(colors is not None)
+    n_verts = _draco_num_puntos(draco, len(mesh.faces))
+    if n_verts is None:
+        # cabecera de una versión de Draco que no se reconoce: decodificar
+        n_verts = np.asarray(DracoPy.decode(draco).points).shape[0]
+    vmin, vmax = _draco_min_max(verts, DRACO_BITS)
+
+    attributes = {"POSITION": 0}
+    draco_attributes = {"POSITION": attr_ids[0]}  # 0 = draco::GeometryAttribute::POSITION
+    accessors = [{
+        "componentType": 5126, "count": n_verts, "type": "VEC3",
+        "min": vmin.tolist(), "max": vmax.tolist(),
+    }]
+    if colors is not None:
+        attributes["COLOR_0"] = len(accessors)
+        draco_attributes["COLOR_0"] = attr_ids[2]  # 2 = draco::GeometryAttribute::COLOR
+        accessors.append({"componentType": 5121, "normalized": True, "count": n_verts, "type": "VEC3"})
+    indices = len(accessors)
+    accessors.append({"componentType": 5125, "count": 3 * len(mesh.faces), "type": "SCALAR"})
+
+    gltf = {
+        "asset": {"version": "2.0"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{
+            "attributes": attributes,
+            "indices": indices,
+            "mode": 4,
+            "extensions": {"KHR_draco_mesh_compression": {"bufferView": 0, "attributes": draco_attributes}},
+        }]}],
+        "accessors": accessors,
+        "bufferViews": [{"buffer": 0, "byteOffset": 0, "byteLength": len(draco)}],
+        "buffers": [{"byteLength": len(draco)}],
+        "extensionsUsed": ["KHR_draco_mesh_compression"],
+        "extensionsRequired": ["KHR_draco_mesh_compression"],
+    }
+
+    # contenedor GLB: cabecera + chunk JSON (relleno con espacios) + chunk BIN (relleno con ceros)
+    json_chunk = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+    json_chunk += b" " * (-len(json_chunk) % 4)
+    bin_chunk = draco + b"\x00" * (-len(draco) % 4)
+    total = 12 + 8 + len(json_chunk) + 8 + len(bin_chunk)
+    with open(tmp, "wb") as fh:
+        fh.write(struct.pack("<III", 0x46546C67, 2, total))
+        fh.write(struct.pack("<II", len(json_chunk), 0x4E4F534A))
+        fh.write(json_chunk)
+        fh.write(struct.pack("<II", len(bin_chunk), 0x004E4942))
+        fh.write(bin_chunk)
+    os.replace(tmp, glb_path)
+    return glb_path
+
+
+def abrir_mosaico(mosaic_path=MOSAIC_PATH):
+    """
+    Devuelve el dataset (solo lectura) de mosaic_path abierto una vez por hilo y
+    reutilizado entre peticiones, para no releer la cabecera y mantener caliente
+    la caché de bloques de GDAL. Un DatasetReader no es thread-safe, por eso uno
+    por hilo. Se reabre si el archivo cambió o si el proceso es un fork.
+    """
+    if getattr(_MOSAICOS, "pid", None) != os.getpid():
+        # tras un fork los handles heredados no se reutilizan
+        _MOSAICOS.pid = os.getpid()
+        _MOSAICOS.datasets = {}
+
+    mtime = os.path.getmtime(mosaic_path)
+    mtime_ds, ds = _MOSAICOS.datasets.get(mosaic_path, (None, None))
+    if ds is None or ds.closed or mtime_ds != mtime:
+        if ds is not None:
+            ds.close()
+        ds = rasterio.open(mosaic_path, sharing=False)
+        _MOSAICOS.datasets[mosaic_path] = (mtime, ds)
+    return ds
+
+
+def recortar_mosaico(src, geom, factor=1):
+    """
+    Lee de src (dataset abierto) la ventana que cubre geom y devuelve
+    (arr, transform, profile) con arr 2D (banda 1). Equivale a
+    rasterio.mask.mask(..., crop=True) pero solo rasteriza la geometría si no
+    es un rectángulo alineado; fuera de ella se pone el nodata del mosaico.
+    factor > 1: lectura decimada por eje (promedio en GDAL, usando overviews);
+    se limita para dejar al menos 2 px por eje (con 1x1 la malla no tiene caras).
+    """
+    shapes = [mapping(geom)]
+    window = geometry_window(src, shapes)
+    transform = src.window_transform(window)
+    h, w = int(round(window.height)), int(round(window.width))
+    factor = max(1, min(factor, h // 2, w // 2))
+    if factor > 1:
+        nh, nw = max(1, h // factor), max(1, w // factor)
+        arr = src.read(1, window=window, out_shape=(nh, nw), resampling=Resampling.average)
+        transform = transform * Affine.scale(w / nw, h / nh)
+    else:
+        arr = src.read(1, window=window)
+
+    if not geom.equals(geom.envelope):
+        fuera = geometry_mask(shapes, out_shape=arr.shape, transform=transform)
+        arr[fuera] = src.nodata if src.nodata is not None else 0
+
+    profile = src.profile.copy()
+    profile.update({"height": arr.shape[0], "width": arr.shape[1], "transform": transform})
+    return arr, transform, profile
+
+
+def malla_recorte(inter_geom, mosaic_path=MOSAIC_PATH, factor=1):
+    """
+    Recorta el mosaico con inter_geom, suaviza y devuelve la malla sólida.
+    factor > 1 decima el recorte (el sigma se reduce igual, en pixels decimados).
+    """
+    # ============================
+    # 1️⃣ Recortar usando la geometría seleccionada
+    src = abrir_mosaico(mosaic_path)
+    out_image, out_transform, profile = recortar_mosaico(src, inter_geom, factor)
+    factor = out_transform.a / src.transform.a  # el efectivo: se limita en recortes pequeños
+
+    # ============================
+    # 2️⃣ Suavizar y escalar (directo sobre el array recortado, sin tif intermedio)
+    arr, profile, transform = suavizar_y_escalar(out_image, out_transform, profile, sigma=SIGMA / factor)
+
+    # ============================
+    # 3️⃣ Generar malla
+    return generar_malla_solida(arr, transform)
+
+
+def configurar_proceso(procesos=1):
+    """
+    Reparte la caché de bloques de GDAL y los hilos (GDAL y numba) entre los
+    `procesos` que mallan a la vez en la máquina. Se llama al arrancar cada proceso
+    de trabajo (initializer del pool, worker de Celery), antes de abrir el mosaico;
+    las variables ya definidas en el entorno tienen prioridad.
+    """
+    procesos = max(1, int(procesos))
+    # CPUs disponibles para este proceso (cpuset de docker/k8s, taskset), no las de la máquina
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    hilos = max(1, cpus // procesos)
+    os.environ.setdefault("GDAL_CACHEMAX", str(max(64, GDAL_CACHE_MB // procesos)))  # MB
+    os.environ.setdefault("GDAL_NUM_THREADS", str(hilos))  # descompresión de tiles LZW
+    os.environ.setdefault("VSI_CACHE", "TRUE")
+    os.environ.setdefault("VSI_CACHE_SIZE", "67108864")  # bytes, por archivo abierto
+    if njit is not None:
+        # numba no admite más hilos que su pool (NUMBA_NUM_THREADS, que manda el entorno)
+        set_num_threads(min(hilos, numba_config.NUMBA_NUM_THREADS))
+
+
+def escribir_estado(job_dir, **estado):
+    """
+    Escribe el estado del job en job_dir/estado.json de forma atómica: lo leen
+    el servidor y otros procesos mientras el worker trabaja.
+    """
+    tmp = os.path.join(job_dir, f".{ESTADO_FILENAME}.{os.getpid()}.tmp")
+    with open(tmp, "w") as fh:
+        json.dump(estado, fh)
+    os.replace(tmp, os.path.join(job_dir, ESTADO_FILENAME))
+
+
+def leer_estado(job_dir):
+    """Estado del job (dict) escrito por escribir_estado, o None si no hay."""
+    try:
+        with open(os.path.join(job_dir, ESTADO_FILENAME)) as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return None
+
+
+def _con_estado(job_dir, fn, *args):
+    """
+    Ejecuta fn(*args) dejando en job_dir el estado "processing" y al final
+    "done" (con el resultado) o "error" (con el mensaje). "done" se escribe solo
+    cuando todos los archivos del job están completos. Mientras corre, el estado
+    conserva lo que dejó el servidor al encolar y añade el pid del worker.
+    """
+    estado = leer_estado(job_dir) or {}
+    estado.update(status="processing", started=time.time(), pid=os.getpid())
+    escribir_estado(job_dir, **estado)
+    try:
+        result = fn(*args)
+    except Exception as e:
+        escribir_estado(job_dir, status="error", message=str(e))
+        raise
+    escribir_estado(job_dir, status="done", **result)
+    return result
+
+
+def procesar_recorte(inter_geom, job_id, mosaic_path=MOSAIC_PATH, outputs_dir=OUTPUT_DIR):
+    """
+    Recorta el mosaico con inter_geom, suaviza, genera la malla y exporta GLB + STL
+    en outputs_dir/<job_id>/. Lo ejecutan los workers (pool de procesos o Celery).
+    Devuelve {"glb_filename", "stl_filename"} (también queda en estado.json).
+    """
+    job_dir = os.path.join(outputs_dir, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    return _con_estado(job_dir, _exportar_recorte, inter_geom, job_id, job_dir, mosaic_path)
+
+
+def _exportar_recorte(inter_geom, job_id, job_dir, mosaic_path):
+    mesh = malla_recorte(inter_geom, mosaic_path)
+
+    # ============================
+    # 4️⃣ Guardar en outputs_dir/<job_id>
+    # Guardar GLB (vista previa en Cesium)
+    glb_filename = f"ecuador_{job_id}.glb"
+    glb_path = os.path.join(job_dir, glb_filename)
+    exportar_glb(mesh, glb_path)
+
+    # Guardar STL (descarga para impresión 3D)
+    stl_filename = f"ecuador_{job_id}.stl"
+    stl_path = os.path.join(job_dir, stl_filename)
+    mesh.export(stl_path, file_type="stl")
+
+    return {"glb_filename": glb_filename, "stl_filename": stl_filename}
+
+
+def procesar_preview(inter_geom, job_id, mosaic_path=MOSAIC_PATH, outputs_dir=OUTPUT_DIR):
+    """
+    Como procesar_recorte pero solo exporta el GLB de vista previa en
+    outputs_dir/<job_id>/, decimado PREVIEW_FACTOR veces por eje (~16x menos
+    vértices). Devuelve {"glb_filename"}.
+    """
+    job_dir = os.path.join(outputs_dir, job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    return _con_estado(job_dir, _exportar_preview, inter_geom, job_id, job_dir, mosaic_path)
+
+
+def _exportar_preview(inter_geom, job_id, job_dir, mosaic_path):
+    mesh = malla_recorte(inter_geom, mosaic_path, factor=PREVIEW_FACTOR)
+
+    glb_filename = f"preview_{job_id}.glb"
+    exportar_glb(mesh, os.path.join(job_dir, glb_filename))
+    return {"glb_filename": glb_filename}
+
+
 # === PROCESO PRINCIPAL (para pruebas locales) ===
 if __name__ == "__main__":
+    configurar_proceso(1)
+
     print("📍 Recortando Ecuador (geojson completo)...")
     tif_ecuador = recortar_tif_by_geojson()
 
     print("🔄 Suavizando y escalando...")
-    arr, profile, transform = suavizar_y_escalar(tif_ecuador, sigma=SIGMA)
+    arr, profile, transform = leer_tif(tif_ecuador)
+    arr, profile, transform = suavizar_y_escalar(arr, transform, profile, sigma=SIGMA)
 
     print("🛠 Generando malla sólida y coloreada...")
     mesh = generar_malla_solida(arr, transform, base_altura=None, vs=VSCALE, vertex_color=True)
 
-    ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    job_dir = os.path.join(OUTPUT_DIR, ts)
+    job_id = str(uuid.uuid4())
+    job_dir = os.path.join(OUTPUT_DIR, job_id)
     os.makedirs(job_dir, exist_ok=True)
-    stl_path = os.path.join(job_dir, f"ecuador_{ts}.stl")
-    glb_path = os.path.join(job_dir, f"ecuador_{ts}.glb")
+    stl_path = os.path.join(job_dir, f"ecuador_{job_id}.stl")
+    glb_path = os.path.join(job_dir, f"ecuador_{job_id}.glb")
 
     print(f"💾 Exportando STL: {stl_path}")
     mesh.export(stl_path)
 
     print(f"💾 Exportando GLB: {glb_path}")
-    mesh.export(glb_path)
+    exportar_glb(mesh, glb_path)
 
     print("✅ Proceso completado.")
@@ -1,17 +1,25 @@
 import os
 import uuid
-import geopandas as gpd
+import re
 from shapely.geometry import box, mapping
+from shapely.geometry.polygon import orient
 import rasterio
-from rasterio.mask import mask
+from rasterio.features import geometry_mask
+from rasterio.merge import merge
 import numpy as np
 import trimesh
 from datetime import datetime
-from pyproj import Transformer
+from pyproj import Geod
+from rasterio.transform import Affine
+
+from procesar_ecuador import block_mean_nan, exportar_glb
 
 # Config (puedes ajustarlo)
 OUTPUTS_DIR = "outputs"
 
+# elipsoide para áreas geodésicas (se crea una sola vez)
+GEOD = Geod(ellps="WGS84")
+
 # ------------------------------
 # Validar que existan archivos HGT
 # ------------------------------
@@ -24,16 +32,47 @@ def validar_archivos_hgt(hgt_dir):
 # ------------------------------
 # Validar que selección esté en Ecuador y no sea muy grande
 # ------------------------------
-def validar_seleccion_ecuador(geom, frontera_ecuador, max_area_km2):
-    inter = geom.intersection(frontera_ecuador)
+def validar_seleccion_ecuador(geom, frontera_ecuador, max_area_km2, frontera_prep=None):
+    # frontera_prep: shapely.prepared.prep(frontera_ecuador), creada una vez al arrancar.
+    # Sus predicados evitan la intersección (cara) si la selección está dentro o fuera del todo
+    if frontera_prep is not None and frontera_prep.contains(geom):
+        inter = geom
+    elif frontera_prep is not None and not frontera_prep.intersects(geom):
+        raise Exception("La selección está fuera de Ecuador.")
+    else:
+        inter = geom.intersection(frontera_ecuador)
     if inter.is_empty:
         raise Exception("La selección está fuera de Ecuador.")
-    # área aproximada (grados -> km2)
-    area_km2 = inter.area * (111 ** 2)
+    # área geodésica sobre el elipsoide (lon/lat directamente, sin reproyectar)
+    area_km2 = area_geodesica_km2(inter)
     if area_km2 > max_area_km2:
         raise Exception(f"Área demasiado grande: {area_km2:.1f} km² (máx {max_area_km2} km²)")
     return inter
 
+# ------------------------------
+# Área geodésica (km²) de una geometría lon/lat
+# ------------------------------
+def area_geodesica_km2(geom):
+    # geometry_area_perimeter devuelve un área con signo según el sentido de giro:
+    # cada polígono se orienta antes (exterior antihorario, huecos horario) para
+    # que partes de una MultiPolygon no se resten entre sí ni los huecos sumen
+    if geom.geom_type == "Polygon":
+        return GEOD.geometry_area_perimeter(orient(geom, 1.0))[0] / 1e6
+    if hasattr(geom, "geoms"):
+        return sum(area_geodesica_km2(g) for g in geom.geoms)
+    return 0.0  # puntos / líneas
+
+# ------------------------------
+# Caja (lon/lat) de un tile HGT a partir de su nombre, p.ej. S01W079.hgt
+# ------------------------------
+def _hgt_tile_box(fn):
+    m = re.match(r"([NS])(\d{2})([EW])(\d{3})", fn.upper())
+    if m is None:
+        return None
+    lat = int(m.group(2)) * (1 if m.group(1) == "N" else -1)
+    lon = int(m.group(4)) * (1 if m.group(3) == "E" else -1)
+    return box(lon, lat, lon + 1, lat + 1)
+
 # ------------------------------
 # Convertir raster recortado a malla (y centrarla)
 # ------------------------------
@@ -46,37 +85,37 @@ def raster_to_mesh_and_center(elev_array, transform, geo_transform_crs_lat):
     rows, cols = elev_array.shape
     # generar coordenadas x,y en lon/lat usando transform
     # transform * (col, row) -> (x, y) (en CRS del raster -- normalmente degrees)
-    xs = np.arange(cols)
-    ys = np.arange(rows)
-    xv, yv = np.meshgrid(xs, ys)
-
-    # calcular coordenadas geográficas (xg, yg) usando transform
-    # transform.c, transform.a etc. are available via rasterio.transform
-    from rasterio.transform import xy
-    coords = [xy(transform, r, c) for r, c in zip(yv.ravel(), xv.ravel())]
-    xs_geo = np.array([c[0] for c in coords])
-    ys_geo = np.array([c[1] for c in coords])
+    # evaluamos el affine directamente (centro de pixel, como rasterio.transform.xy);
+    # en float32 trabajamos con desplazamientos respecto al origen (c, f) para no perder precisión
+    col = np.arange(cols, dtype=np.float32) + 0.5
+    row = (np.arange(rows, dtype=np.float32) + 0.5)[:, None]
+    xs_geo = col * np.float32(transform.a) + row * np.float32(transform.b)
+    ys_geo = col * np.float32(transform.d) + row * np.float32(transform.e)
 
     # convertir lon/lat (deg) a metros aproximados relativos (usamos proyección local)
     # si la unidad del raster es grados, convertir a metros usando una proyección local basada en latitud media
     # estimar latitud media:
-    lat_mean = np.mean(ys_geo)
+    ys_mean = ys_geo.mean()
+    lat_mean = transform.f + ys_mean
     # metros por grado aproximado
-    meters_per_deg = 111320 * np.cos(np.deg2rad(lat_mean))
-    xs_m = (xs_geo - np.mean(xs_geo)) * meters_per_deg
-    ys_m = (ys_geo - np.mean(ys_geo)) * meters_per_deg
+    meters_per_deg = np.float32(111320 * np.cos(np.deg2rad(lat_mean)))
+    xs_m = (xs_geo - xs_geo.mean()) * meters_per_deg
+    ys_m = (ys_geo - ys_mean) * meters_per_deg
 
     zs = np.nan_to_num(elev_array.ravel(), nan=0.0)
 
-    verts = np.column_stack((xs_m, ys_m, zs))
-    faces = []
-    for r in range(rows - 1):
-        for c in range(cols - 1):
-            i = r * cols + c
-            faces.append([i, i + 1, i + cols])
-            faces.append([i + 1, i + cols + 1, i + cols])
+    verts = np.empty((rows * cols, 3), dtype=np.float32)
+    verts[:, 0] = xs_m.ravel()
+    verts[:, 1] = ys_m.ravel()
+    verts[:, 2] = zs
+    r, c = np.mgrid[:rows - 1, :cols - 1].astype(np.int32)
+    i = (r * cols + c).ravel()
+    faces = np.stack([
+        np.column_stack([i, i + 1, i + cols]),
+        np.column_stack([i + 1, i + cols + 1, i + cols]),
+    ], axis=1).reshape(-1, 3)
 
-    return verts, np.array(faces)
+    return verts, faces
 
 # ------------------------------
 # Procesar y exportar selección a GLB
@@ -91,79 +130,38 @@ def clip_and_process_job(geom, hgt_dir):
     output_dir = os.path.join(OUTPUTS_DIR, job_id)
     os.makedirs(output_dir, exist_ok=True)
 
-    # GeoDataFrame con la geometría (en EPSG:4326)
-    gdf = gpd.GeoDataFrame({"geometry": [geom]}, crs="EPSG:4326")
-
-    merged = None
-    merged_transform = None
-    used_any = False
-
-    # Recorrer archivos .hgt
-    for fn in os.listdir(hgt_dir):
+    # HGT candidatos: se filtran por el nombre (esquina SO del tile de 1°x1°)
+    # para no abrir tiles que no intersectan la selección
+    paths = []
+    for fn in sorted(os.listdir(hgt_dir)):
         if not fn.lower().endswith(".hgt"):
             continue
-        path = os.path.join(hgt_dir, fn)
-        try:
-            with rasterio.open(path) as src:
-                # asegurarse de que la geometría esté en la misma CRS que el raster
-                raster_crs = src.crs.to_string() if src.crs else "EPSG:4326"
-                if raster_crs.upper() != "EPSG:4326":
-                    gdf_in_src = gdf.to_crs(src.crs)
-                    geom_in_src = gdf_in_src.geometry.values[0]
-                else:
-                    geom_in_src = gdf.geometry.values[0]
-
-                tile_box = box(*src.bounds)
-                # transform geom to raster CRS when comparing
-                if src.crs and src.crs.to_string().upper() != "EPSG:4326":
-                    # ensure tile_box and geom_in_src are same CRS already above
-                    pass
-
-                if not geom_in_src.intersects(tile_box):
-                    continue
-
-                # intentar recorte - pasar lista de geometrías como mapping()
-                try:
-                    out_image, out_transform = mask(src, [mapping(geom_in_src)], crop=True, all_touched=False)
-                except Exception as e:
-                    # si falla el mask para este tile, continuar
-                    print(f"[processing] mask failed for {fn}: {e}")
-                    continue
-
-                # out_image shape: (bands, rows, cols), HGT suele tener 1 banda
-                band = out_image[0].astype(float)
-
-                # manejar nodata
-                nod = src.nodatavals[0] if src.nodatavals else None
-                if nod is not None:
-                    band[band == nod] = np.nan
-
-                if merged is None:
-                    merged = band
-                    merged_transform = out_transform
-                else:
-                    # alinear shapes si difieren (sencillo: pad arrays to same shape)
-                    # aquí asumimos mismos tamaños por crop similar; si difieren, hacemos pad
-                    if band.shape != merged.shape:
-                        # compute new shape
-                        rmax = max(merged.shape[0], band.shape[0])
-                        cmax = max(merged.shape[1], band.shape[1])
-                        mnew = np.full((rmax, cmax), np.nan)
-                        bnew = np.full((rmax, cmax), np.nan)
-                        # place merged at top-left
-                        mnew[:merged.shape[0], :merged.shape[1]] = merged
-                        bnew[:band.shape[0], :band.shape[1]] = band
-                        merged = np.nanmax(np.stack([mnew, bnew], axis=0), axis=0)
-                    else:
-                        merged = np.nanmax(np.stack([merged, band], axis=0), axis=0)
-                used_any = True
-        except Exception as e:
-            print(f"[processing] error reading {path}: {e}")
-            continue
-
-    if not used_any or merged is None:
+        tile_box = _hgt_tile_box(fn)
+        if tile_box is None or geom.intersects(tile_box):
+            paths.append(os.path.join(hgt_dir, fn))
+    if not paths:
         raise Exception("No se encontraron datos HGT para la selección (merged empty).")
 
+    # mosaico virtual de los tiles, leído una sola vez dentro de los límites de la geometría
+    datasets = [rasterio.open(p) for p in paths]
+    try:
+        nod = datasets[0].nodata
+        if nod is None:
+            nod = -32768
+        mosaic, merged_transform = merge(datasets, bounds=geom.bounds, nodata=nod, method="max")
+    finally:
+        for ds in datasets:
+            ds.close()
+
+    # out shape: (bands, rows, cols), HGT suele tener 1 banda
+    merged = mosaic[0].astype(np.float32)
+    merged[merged == nod] = np.nan
+
+    # una sola rasterización de la geometría para descartar lo que queda fuera
+    inside = geometry_mask([mapping(geom)], out_shape=merged.shape,
+                           transform=merged_transform, invert=True)
+    merged[~inside] = np.nan
+
     # comprobar si hay valores válidos
     if np.isnan(merged).all():
         raise Exception("Los datos resultantes contienen solo nodata/NaN. Selección sin cobertura HGT.")
@@ -172,12 +170,11 @@ def clip_and_process_job(geom, hgt_dir):
     max_pixels = 1200 * 1200  # límite
     rows, cols = merged.shape
     if rows * cols > max_pixels:
-        factor = np.sqrt((rows * cols) / max_pixels)
-        new_rows = max(2, int(rows / factor))
-        new_cols = max(2, int(cols / factor))
+        # factor entero para que el rebin sea exacto (y el transform también)
+        factor = int(np.ceil(np.sqrt((rows * cols) / max_pixels)))
         # remuestrear por simple rebin (media)
-        merged = resize_array_by_mean(merged, new_rows, new_cols)
-        # NOTE: transform loses exactness; acceptable para preview/export reduced
+        merged = resize_array_by_mean(merged, factor)
+        merged_transform = merged_transform * Affine.scale(factor)
 
     # crear malla y exportar glb
     verts, faces = raster_to_mesh_and_center(merged, merged_transform, None)
@@ -185,29 +182,15 @@ def clip_and_process_job(geom, hgt_dir):
     if verts.shape[0] < 4 or faces.shape[0] < 1:
         raise Exception("La malla generada es degenerada (pocos vértices).")
 
-    mesh = trimesh.Trimesh(vertices=verts, faces=faces, process=True)
-    if not mesh.is_watertight and mesh.vertices.shape[0] < 100000:
-        # ok, no es requisito watertight para GLB, sigue
-        pass
+    # malla de grilla regular: no necesita el merge/dedup de process=True
+    mesh = trimesh.Trimesh(vertices=verts, faces=faces, process=False)
 
     glb_filename = f"ecuador_{datetime.now().strftime('%Y%m%d_%H%M%S')}.glb"
     glb_path = os.path.join(output_dir, glb_filename)
-    mesh.export(glb_path)
+    exportar_glb(mesh, glb_path)
 
     return job_id, glb_filename
 
 # helper: simple downsample by block mean
-def resize_array_by_mean(arr, new_r, new_c):
-    r, c = arr.shape
-    rr = np.linspace(0, r, new_r+1, dtype=int)
-    cc = np.linspace(0, c, new_c+1, dtype=int)
-    out = np.full((new_r, new_c), np.nan)
-    for i in range(new_r):
-        for j in range(new_c):
-            block = arr[rr[i]:rr[i+1], cc[j]:cc[j+1]]
-            if block.size == 0:
-                out[i,j] = np.nan
-            else:
-                val = np.nanmean(block)
-                out[i,j] = val
-    return out
+def resize_array_by_mean(arr, factor):
+    return block_mean_nan(arr, factor, factor)
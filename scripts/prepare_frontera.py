@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+"""
+prepare_frontera.py
+Precalcula la frontera de Ecuador (unión de los polígonos ADM2 en EPSG:4326) y la
+guarda como pickle junto al geojson, para que el servidor arranque con un pickle.load
+en lugar de leer el GeoJSON y hacer unary_union en cada worker.
+"""
+
+import os
+import sys
+
+# RUTAS (ajusta si quieres)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # proyecto/scripts/.. => proyecto
+sys.path.insert(0, ROOT)
+GEOJSON = os.path.join(ROOT, "data", "geoBoundaries-ECU-ADM2_simplified.geojson")
+
+from procesar_ecuador import cargar_frontera
+
+if not os.path.exists(GEOJSON):
+    raise SystemExit(f"No se encuentra {GEOJSON}")
+
+frontera = cargar_frontera(GEOJSON)
+print(f"Frontera ({frontera.geom_type}) guardada en:", GEOJSON + ".pkl")
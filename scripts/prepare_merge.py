@@ -9,6 +9,7 @@ import glob
 import numpy as np
 import rasterio
 from rasterio.merge import merge
+from rasterio.enums import Resampling
 import matplotlib.pyplot as plt
 
 # RUTAS (ajusta si quieres)
@@ -47,13 +48,25 @@ out_meta.update({
     "transform": out_trans,
     "count": 1,
     "dtype": "float32",
-    "crs": src_files_to_mosaic[0].crs
+    "crs": src_files_to_mosaic[0].crs,
+    # GeoTIFF en bloques comprimidos: lecturas por ventana/decimadas solo tocan los bloques necesarios
+    "tiled": True,
+    "blockxsize": 512,
+    "blockysize": 512,
+    "compress": "LZW",
+    "predictor": 3,
+    "BIGTIFF": "YES"
 })
 
 out_tif = os.path.join(OUT_DIR, "mosaic.tif")
 with rasterio.open(out_tif, "w", **out_meta) as dest:
     dest.write(arr, 1)
 
+# Overviews para lecturas decimadas (src.read(out_shape=...)) rápidas
+with rasterio.open(out_tif, "r+") as ds:
+    ds.build_overviews([2, 4, 8, 16, 32], Resampling.average)
+    ds.update_tags(ns="rio_overview", resampling="average")
+
 print("Mosaic guardado en:", out_tif)
 # No optimizaodo
 '''''
@@ -77,14 +90,20 @@ plt.show()
 '''
 # Otimizado
 # --- Preview gráfico y guardado ---
-left = out_trans.c
-top = out_trans.f
-right = left + out_trans.a * arr.shape[1]
-bottom = top + out_trans.e * arr.shape[0]
+# liberar el mosaico completo: el preview se lee decimado desde el tif
+del arr, mosaic
 
-# Reducir resolución para evitar consumir mucha RAM
+# Reducir resolución para evitar consumir mucha RAM: lectura decimada con promedio
+# (usa las overviews, sin aliasing como arr[::f, ::f])
 factor_preview = 10  # aumenta este número para reducir más
-arr_preview = arr[::factor_preview, ::factor_preview]
+with rasterio.open(out_tif) as src:
+    arr_preview = src.read(
+        1,
+        out_shape=(src.height // factor_preview, src.width // factor_preview),
+        resampling=Resampling.average,
+        masked=True,
+    ).filled(np.nan)
+    left, bottom, right, top = src.bounds
 
 plt.figure(figsize=(10, 6))
 plt.imshow(arr_preview, extent=(left, right, bottom, top))
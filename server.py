@@ -1,15 +1,20 @@
-from flask import Flask, send_from_directory, request, jsonify
+from flask import Flask, send_from_directory, send_file, request, jsonify
 from flask_cors import CORS
+from flask_caching import Cache
 import os
+import json
+import hashlib
 import logging
-import geopandas as gpd
 from shapely.geometry import shape, mapping
-import glob
-import datetime
-import rasterio.mask
+from shapely.prepared import prep
+import uuid
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 
 # Importar funciones desde procesar_ecuador.py
-from procesar_ecuador import suavizar_y_escalar, generar_malla_solida
+from procesar_ecuador import (cargar_frontera, procesar_recorte, procesar_preview, escribir_estado,
+                              leer_estado, configurar_proceso)
 # Importar funciones de validación desde processing.py
 from processing import validar_archivos_hgt, validar_seleccion_ecuador
 
@@ -28,18 +33,51 @@ for path in [STATIC_DIR, DATA_DIR, HGT_DIR, OUTPUTS_DIR]:
     os.makedirs(path, exist_ok=True)
 
 app = Flask(__name__, static_folder=STATIC_DIR, static_url_path="")
-CORS(app)
+CORS(app, expose_headers=["X-Glb-Url"])
 app.logger.setLevel(logging.DEBUG)
 
+# Caché de resultados por geometría (en disco, compartida entre procesos)
+CACHE_TIMEOUT = 86400
+# Celery no distingue una tarea en cola de una desconocida (ambas PENDING), ni una
+# STARTED de una cuyo worker murió (y un pid puede reutilizarse): pasado este tiempo
+# sin estado final, el job se da por perdido
+JOB_TIMEOUT = 3600
+CACHE_DIR = os.path.join(BASE_DIR, "cache")  # fuera de outputs/, que se sirve por HTTP
+cache = Cache(app, config={"CACHE_TYPE": "FileSystemCache", "CACHE_DIR": CACHE_DIR})
+
 # Comprobar existencia de GeoJSON
 if not os.path.exists(ECUADOR_GEOJSON):
     app.logger.error(f"No existe {ECUADOR_GEOJSON}")
     raise FileNotFoundError(f"Falta archivo {ECUADOR_GEOJSON}")
 
-# Cargar frontera de Ecuador
-frontera_ecuador = gpd.read_file(ECUADOR_GEOJSON).to_crs("EPSG:4326").unary_union
+# Cargar frontera de Ecuador (cacheada en pickle junto al geojson)
+frontera_ecuador = cargar_frontera(ECUADOR_GEOJSON)
+frontera_ecuador_prep = prep(frontera_ecuador)  # predicados rápidos en validar_seleccion_ecuador
 app.logger.info("Frontera de Ecuador cargada correctamente.")
 
+# Pool de procesos para el recorte + mallado (CPU) fuera del hilo de la petición.
+# Tamaño fijo y pequeño: cada job ya usa varios hilos (GDAL, numba) y gunicorn corre
+# un solo worker (gunicorn.conf.py), así que hay un único pool por servidor.
+# forkserver: los procesos no se clonan desde este proceso con hilos (gthread)
+MESH_WORKERS = int(os.environ.get("MESH_WORKERS", 2))
+_MP_METODO = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+# cada proceso del pool recibe su parte de la caché e hilos de GDAL/numba
+EXECUTOR = ProcessPoolExecutor(max_workers=MESH_WORKERS, mp_context=multiprocessing.get_context(_MP_METODO),
+                               initializer=configurar_proceso, initargs=(MESH_WORKERS,))
+JOBS = {}  # job_id -> Future (solo los de este proceso; el estado compartido está en disco)
+
+# Celery (opcional): con CELERY_BROKER_URL definido, /api/clip encola en los workers
+# de Celery (cola "mesh") en lugar del pool local
+if os.environ.get("CELERY_BROKER_URL"):
+    from tasks import celery as celery_app, process_clip
+else:
+    celery_app = process_clip = None
+
+def clave_geometria(prefix, geom_json):
+    """Clave de caché: hash del GeoJSON canonicalizado (claves ordenadas)."""
+    digest = hashlib.blake2b(json.dumps(geom_json, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return f"{prefix}:{digest}"
+
 @app.route("/")
 def index():
     return send_from_directory(STATIC_DIR, "index.html")
@@ -82,133 +120,198 @@ def api_clip():
         else:
             return jsonify({"error": "Falta geometría"}), 400
 
+        # Misma geometría ya enviada: devolver su job (terminado o en curso)
+        key = clave_geometria("clip", geom_json)
+        cached = cache.get(key)
+        if cached:
+            payload, code = estado_job(cached["job_id"])
+            if code == 200:
+                payload.update({"job_id": cached["job_id"], "inter_geojson": cached["inter_geojson"]})
+                return jsonify(payload), 200 if payload["status"] == "done" else 202
+            # job fallido o borrado: se vuelve a procesar
+            cache.delete(key)
+
         geom = shape(geom_json)
 
         # Validar archivos HGT
         validar_archivos_hgt(HGT_DIR)
 
         # Validar que esté dentro de Ecuador y no exceda el tamaño
-        inter_geom = validar_seleccion_ecuador(geom, frontera_ecuador, MAX_AREA_KM2)
+        inter_geom = validar_seleccion_ecuador(geom, frontera_ecuador, MAX_AREA_KM2, frontera_ecuador_prep)
 
-        # ============================
-        # 1️⃣ Recortar usando la geometría seleccionada
         MOSAIC_PATH = os.path.join(DATA_DIR, "mosaic.tif")
         if not os.path.exists(MOSAIC_PATH):
             return jsonify({"error": "No se encuentra mosaic.tif en data/"}), 500
 
-        tif_temp = os.path.join(OUTPUTS_DIR, "temp_clip.tif")
-        with rasterio.open(MOSAIC_PATH) as src:
-            out_image, out_transform = rasterio.mask.mask(src, [mapping(inter_geom)], crop=True)
-            profile = src.profile
-            profile.update({
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform
-            })
-            with rasterio.open(tif_temp, "w", **profile) as dest:
-                dest.write(out_image)
-
-        # ============================
-        # 2️⃣ Suavizar y escalar
-        arr, profile, transform = suavizar_y_escalar(tif_temp)
-
-        # ============================
-        # 3️⃣ Generar malla
-        mesh = generar_malla_solida(arr, transform)
-
-        # ============================
-        # 4️⃣ Guardar con un job_id único
-        job_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Encolar el procesamiento pesado (Celery o pool de procesos); el cliente
+        # consulta /api/status/<job_id> hasta que termine
+        job_id = str(uuid.uuid4())
         job_dir = os.path.join(OUTPUTS_DIR, job_id)
         os.makedirs(job_dir, exist_ok=True)
+        # GeoJSON de la intersección: se serializa una sola vez (Celery, caché y respuesta)
+        inter_geojson = mapping(inter_geom)
+        # estado inicial antes de encolar: el worker lo sobrescribe al empezar
+        status = "queued" if process_clip is not None else "pending"
+        if process_clip is not None:
+            escribir_estado(job_dir, status=status, created=time.time(), cola="celery")
+            process_clip.apply_async(args=[job_id, inter_geojson, MOSAIC_PATH, OUTPUTS_DIR], task_id=job_id)
+        else:
+            # pid de este proceso: otros workers de gunicorn saben si el pool sigue vivo
+            escribir_estado(job_dir, status=status, created=time.time(), cola="pool", pid=os.getpid())
+            JOBS[job_id] = EXECUTOR.submit(procesar_recorte, inter_geom, job_id, MOSAIC_PATH, OUTPUTS_DIR)
 
-        # Guardar GLB (vista previa en Cesium)
-        glb_filename = f"ecuador_{job_id}.glb"
-        glb_path = os.path.join(job_dir, glb_filename)
-        mesh.export(glb_path)
-
-        # Guardar STL (descarga para impresión 3D)
-        stl_filename = f"ecuador_{job_id}.stl"
-        stl_path = os.path.join(job_dir, stl_filename)
-        mesh.export(stl_path, file_type="stl")
+        cache.set(key, {"job_id": job_id, "inter_geojson": inter_geojson}, timeout=CACHE_TIMEOUT)
 
-        # ============================
-        # 5️⃣ Respuesta
         return jsonify({
-            "status": "ok",
+            "status": status,
             "job_id": job_id,
-            "glb_url": f"/outputs/{job_id}/{glb_filename}",  # para previsualizar
-            "stl_url": f"/outputs/{job_id}/{stl_filename}",  # para descargar
-            "inter_geojson": mapping(inter_geom)
-        }), 200
+            "inter_geojson": inter_geojson
+        }), 202
 
     except Exception as e:
         app.logger.exception("Error procesando selección")
         return jsonify({"error": f"Error procesando selección: {str(e)}"}), 500
 
+def respuesta_job(job_id, result):
+    payload = {
+        "status": "done",
+        "job_id": job_id,
+        "glb_url": f"/outputs/{job_id}/{result['glb_filename']}"  # para previsualizar
+    }
+    if "stl_filename" in result:  # los jobs de preview solo generan GLB
+        payload["stl_url"] = f"/outputs/{job_id}/{result['stl_filename']}"  # para descargar
+    return payload
+
+def estado_job(job_id):
+    """
+    Devuelve (payload, http_code) con el estado del job. El estado final (done/error)
+    lo deja el worker en outputs/<job_id>/estado.json; mientras no exista se consulta
+    el Future local, la tarea de Celery o, para jobs del pool de otro worker de
+    gunicorn, si sigue vivo el proceso que lo tiene (pid en estado.json). Un job sin
+    estado final ni tarea viva (reinicio del servidor, worker caído) se da por perdido (410).
+    """
+    job_dir = os.path.join(OUTPUTS_DIR, job_id)
+    if not os.path.isdir(job_dir):
+        return {"status": "error", "message": "Job no encontrado"}, 404
+
+    estado = leer_estado(job_dir) or {}
+    if estado.get("status") == "done":
+        JOBS.pop(job_id, None)
+        return respuesta_job(job_id, estado), 200
+    if estado.get("status") == "error":
+        JOBS.pop(job_id, None)
+        return {"status": "error", "message": f"Error procesando selección: {estado.get('message')}"}, 500
+
+    future = JOBS.get(job_id)
+    if future is not None:
+        if not future.done():
+            return {"status": "processing"}, 200
+        # terminó entre la lectura de estado.json y esta consulta: vale su resultado
+        exc = future.exception()
+        JOBS.pop(job_id, None)
+        if exc is None:
+            return respuesta_job(job_id, future.result()), 200
+        app.logger.error(f"Job {job_id} falló: {exc}")
+        return {"status": "error", "message": f"Error procesando selección: {exc}"}, 500
+
+    if estado.get("cola") == "pool":
+        if proceso_vivo(estado.get("pid")) and \
+                time.time() - estado.get("started", estado.get("created", 0)) < JOB_TIMEOUT:
+            return {"status": "processing"}, 200
+    elif celery_app is not None:
+        res = celery_app.AsyncResult(job_id)
+        if res.state == "SUCCESS":
+            return respuesta_job(job_id, res.result), 200
+        if res.state == "FAILURE":
+            app.logger.error(f"Job {job_id} falló: {res.result}")
+            return {"status": "error", "state": res.state,
+                    "message": f"Error procesando selección: {res.result}"}, 500
+        if time.time() - estado.get("started", estado.get("created", 0)) < JOB_TIMEOUT:
+            # PENDING / STARTED / RETRY
+            return {"status": "processing", "state": res.state}, 200
+
+    return {"status": "error", "message": "El job se interrumpió sin resultado; vuelve a enviarlo"}, 410
+
+def proceso_vivo(pid):
+    """True si existe el proceso pid en esta máquina (señal 0: no lo afecta)."""
+    if not pid or os.name == "nt":  # en Windows os.kill termina el proceso
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
 @app.route("/api/status/<job_id>", methods=["GET"])
 def api_status(job_id):
     try:
-        job_dir = os.path.join(OUTPUTS_DIR, job_id)
-        if not os.path.exists(job_dir):
-            return jsonify({"status": "error", "message": "Job no encontrado"}), 404
-        glb_files = glob.glob(os.path.join(job_dir, "*.glb"))
-        if glb_files:
-            name = os.path.basename(glb_files[0])
-            return jsonify({"status": "done", "glb_url": f"/outputs/{job_id}/{name}"}), 200
-        return jsonify({"status": "processing"}), 200
+        payload, code = estado_job(job_id)
+        return jsonify(payload), code
     except Exception as e:
         app.logger.exception("Error en /api/status")
         return jsonify({"status": "error", "message": str(e)}), 500
 
 @app.route("/api/preview", methods=["POST"])
 def preview_model():
-    import json, numpy as np
     try:
         data = request.get_json(force=True)
         if not data or "geometry" not in data:
             return jsonify({"error": "Falta geometría"}), 400
 
+        # Misma geometría ya previsualizada: devolver su job (terminado o en curso)
+        key = clave_geometria("preview", data["geometry"])
+        cached = cache.get(key)
+        if cached:
+            payload, code = estado_job(cached["job_id"])
+            if code == 200:
+                payload["job_id"] = cached["job_id"]
+                return jsonify(payload), 200 if payload["status"] == "done" else 202
+            cache.delete(key)
+
         geom = shape(data["geometry"])
         validar_archivos_hgt(HGT_DIR)
-        inter_geom = validar_seleccion_ecuador(geom, frontera_ecuador, MAX_AREA_KM2)
+        inter_geom = validar_seleccion_ecuador(geom, frontera_ecuador, MAX_AREA_KM2, frontera_ecuador_prep)
 
         MOSAIC_PATH = os.path.join(DATA_DIR, "mosaic.tif")
         if not os.path.exists(MOSAIC_PATH):
             return jsonify({"error": "No se encuentra mosaic.tif"}), 500
 
-        with rasterio.open(MOSAIC_PATH) as src:
-            out_image, out_transform = rasterio.mask.mask(src, [mapping(inter_geom)], crop=True)
-            profile = src.profile
-            profile.update({
-                "height": out_image.shape[1],
-                "width": out_image.shape[2],
-                "transform": out_transform
-            })
-
-            temp_tif = os.path.join(OUTPUTS_DIR, "temp_preview.tif")
-            with rasterio.open(temp_tif, "w", **profile) as dest:
-                dest.write(out_image)
-
-        arr, profile, transform = suavizar_y_escalar(temp_tif)
-        mesh = generar_malla_solida(arr, transform)
-
-        job_id = f"preview_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        # Mismo pool que /api/clip: la petición vuelve enseguida y el cliente
+        # consulta /api/preview/<job_id> hasta que el GLB esté listo
+        job_id = f"preview_{uuid.uuid4()}"
         job_dir = os.path.join(OUTPUTS_DIR, job_id)
         os.makedirs(job_dir, exist_ok=True)
-        glb_filename = f"preview_{job_id}.glb"
-        glb_path = os.path.join(job_dir, glb_filename)
-        mesh.export(glb_path)
+        escribir_estado(job_dir, status="pending", created=time.time(), cola="pool", pid=os.getpid())
+        JOBS[job_id] = EXECUTOR.submit(procesar_preview, inter_geom, job_id, MOSAIC_PATH, OUTPUTS_DIR)
+        cache.set(key, {"job_id": job_id}, timeout=CACHE_TIMEOUT)
 
-        return jsonify({
-            "status": "ok",
-            "glb_url": f"/outputs/{job_id}/{glb_filename}"
-        }), 200
+        return jsonify({"status": "pending", "job_id": job_id}), 202
     except Exception as e:
         app.logger.exception("Error en preview_model")
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/preview/<job_id>", methods=["GET"])
+def preview_status(job_id):
+    try:
+        payload, code = estado_job(job_id)
+        # Con "Accept: model/gltf-binary" el GLB terminado va en esta misma respuesta
+        # (sin otra petición a /outputs); su URL persistente queda en X-Glb-Url
+        if payload.get("status") == "done" and \
+                request.accept_mimetypes.best_match(["application/json", "model/gltf-binary"]) == "model/gltf-binary":
+            glb_path = os.path.join(OUTPUTS_DIR, payload["glb_url"][len("/outputs/"):])
+            response = send_file(glb_path, mimetype="model/gltf-binary")
+            response.headers["X-Glb-Url"] = payload["glb_url"]
+            return response
+        return jsonify(payload), code
+    except Exception as e:
+        app.logger.exception("Error en /api/preview/<job_id>")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 
 
 if __name__ == "__main__":
-    app.run(host="127.0.0.1", port=5000, debug=True)
+    # servidor de desarrollo (un solo proceso); en producción usar gunicorn.conf.py.
+    # FLASK_DEBUG=1 activa el debugger/reloader
+    app.run(host="127.0.0.1", port=5000, debug=os.environ.get("FLASK_DEBUG") == "1")
@@ -0,0 +1,40 @@
+"""
+tasks.py
+Tarea Celery para el recorte + mallado de /api/clip.
+Opcional: server.py solo la usa si CELERY_BROKER_URL está definido.
+
+Worker (cola "mesh", para máquinas con CPU dedicada). La concurrencia se fija con
+MESH_WORKERS (no con -c) para que cada proceso reciba su parte de caché e hilos:
+    MESH_WORKERS=2 celery -A tasks worker -Q mesh
+"""
+
+import os
+from celery import Celery
+from celery.signals import worker_process_init
+from shapely.geometry import shape
+
+from procesar_ecuador import procesar_recorte, configurar_proceso
+
+BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379/0")
+RESULT_BACKEND = os.environ.get("CELERY_RESULT_BACKEND", BROKER_URL)
+MESH_WORKERS = int(os.environ.get("MESH_WORKERS", 2))  # procesos de mallado por máquina
+
+celery = Celery("mapa_ecu3", broker=BROKER_URL, backend=RESULT_BACKEND)
+celery.conf.update(
+    task_track_started=True,  # estado STARTED visible en /api/status
+    task_routes={"process_clip": {"queue": "mesh"}},
+    worker_prefetch_multiplier=1,  # tareas largas: no acaparar la cola
+    worker_concurrency=MESH_WORKERS,
+)
+
+
+@worker_process_init.connect
+def _configurar_worker(**kwargs):
+    """Caché e hilos de GDAL/numba repartidos entre los procesos del worker."""
+    configurar_proceso(MESH_WORKERS)
+
+
+@celery.task(name="process_clip")
+def process_clip(job_id, geom_json, mosaic_path, outputs_dir):
+    """geom_json: GeoJSON (EPSG:4326) de la selección ya validada."""
+    return procesar_recorte(shape(geom_json), job_id, mosaic_path, outputs_dir)